@@ -1,5 +1,5 @@
 import json
-from util import Counter
+from util import Counter, CounterFast
 
 def get_cond_distr(distr, e):
   """
@@ -67,8 +67,8 @@ class NoteProbabilityDistributions(object):
     self.degree_distrs = {}
     self.duration_distrs = {}
     for key in ["prev_degree", "prev_duration", "velocity", "tempo"]:
-      self.degree_distrs[key] = Counter()
-      self.duration_distrs[key] = Counter()
+      self.degree_distrs[key] = CounterFast()
+      self.duration_distrs[key] = CounterFast()
 
     for deg in range(12):
       for i in range(12):
@@ -13,39 +13,82 @@
 # Pieter Abbeel (pabbeel@cs.berkeley.edu).
 
 
+import math
 import random
 import bisect
-import UserDict
-from collections import OrderedDict
+from operator import itemgetter
+from collections import MutableMapping, defaultdict
 
-class ForwardFillSeries(UserDict.DictMixin):
+class ForwardFillSeries(MutableMapping):
   """
   A series object that implements the Dictionary interface that forward fills
   missing values; if the key value does not exist, the closest valid key that
   comes before is used. Used primarily when observing global state that changes
   over time to see what the particular state is at a given time.
   """
-  def __init__(self, init_dict = OrderedDict(), default_val = None):
-    self.items = init_dict
+  def __init__(self, init_dict = None, default_val = None):
+    # Keys and values are kept in parallel lists sorted by key, so lookups
+    # can bisect directly without rebuilding a key list
+    self._keys, self._values = [], []
     self.default_val = default_val
+    if init_dict is not None:
+      self.update(init_dict)
 
   def __getitem__(self, key):
-    keys = self.items.keys()
-    index = bisect.bisect_right(keys, key) - 1
+    index = bisect.bisect_right(self._keys, key) - 1
     if index < 0:
       if self.default_val:
         return self.default_val
       else:
         raise KeyError(str(key) + " : Provided key is before any valid point.")
-    return self.items[keys[index]]
+    return self._values[index]
   def __setitem__(self, key, value):
-    keys = self.items.keys()
-    index = bisect.bisect_right(keys, key)
-    items = self.items.items()
-    items.insert(index, (key, value))
-    self.items = OrderedDict(items)
+    index = bisect.bisect_right(self._keys, key)
+    if index > 0 and self._keys[index - 1] == key:
+      self._values[index - 1] = value
+    else:
+      self._keys.insert(index, key)
+      self._values.insert(index, value)
   def __delitem__(self, item):
-    del self.items[item]
+    index = bisect.bisect_left(self._keys, item)
+    if index == len(self._keys) or self._keys[index] != item:
+      raise KeyError(item)
+    del self._keys[index]
+    del self._values[index]
+  def update(self, other = (), **kwargs):
+    """
+    Inserts many key/value pairs at once. The new pairs are sorted and merged
+    into the existing keys in a single pass instead of shifting the lists once
+    per insert. As with dict.update, new values replace those of existing keys.
+    """
+    pairs = sorted(dict(other, **kwargs).items())
+    keys, values = self._keys, self._values
+    merged_keys, merged_values = [], []
+    i = j = 0
+    while i < len(keys) and j < len(pairs):
+      key, value = pairs[j]
+      if keys[i] < key:
+        merged_keys.append(keys[i])
+        merged_values.append(values[i])
+        i += 1
+      else:
+        if keys[i] == key:
+          i += 1
+        merged_keys.append(key)
+        merged_values.append(value)
+        j += 1
+    merged_keys.extend(keys[i:])
+    merged_values.extend(values[i:])
+    merged_keys.extend(k for k, _ in pairs[j:])
+    merged_values.extend(v for _, v in pairs[j:])
+    self._keys, self._values = merged_keys, merged_values
+  def __iter__(self):
+    return iter(self._keys)
+  def __len__(self):
+    return len(self._keys)
+  def __contains__(self, key):
+    index = bisect.bisect_left(self._keys, key)
+    return index < len(self._keys) and self._keys[index] == key
 
 class Counter(dict):
     """
@@ -87,9 +130,10 @@ class Counter(dict):
     subtracted or multiplied together.  See below for details.  They can
     also be normalized and their total count and arg max can be extracted.
     """
+    __slots__ = ()
+
     def __getitem__(self, idx):
-        self.setdefault(idx, 0)
-        return dict.__getitem__(self, idx)
+        return dict.get(self, idx, 0)
 
     def incrementAll(self, keys, count):
         """
@@ -109,11 +153,8 @@ class Counter(dict):
         """
         Returns the key with the highest value.
         """
-        if len(self.keys()) == 0: return None
-        all = self.items()
-        values = [x[1] for x in all]
-        maxIndex = values.index(max(values))
-        return all[maxIndex][0]
+        if len(self) == 0: return None
+        return max(self.iteritems(), key=itemgetter(1))[0]
 
     def sortedKeys(self):
         """
@@ -127,10 +168,7 @@ class Counter(dict):
         >>> a.sortedKeys()
         ['second', 'third', 'first']
         """
-        sortedItems = self.items()
-        compare = lambda x, y:  sign(y[1] - x[1])
-        sortedItems.sort(cmp=compare)
-        return [x[0] for x in sortedItems]
+        return sorted(self, key=self.__getitem__, reverse=True)
 
     def totalCount(self):
         """
@@ -145,18 +183,19 @@ class Counter(dict):
         will remain the same. Note that normalizing an empty
         Counter will result in an error.
         """
-        total = float(self.totalCount())
+        total = float(sum(self.itervalues()))
         if total == 0: return
-        for key in self.keys():
-            self[key] = self[key] / total
+        inverse = 1.0 / total
+        for key in self:
+            dict.__setitem__(self, key, dict.__getitem__(self, key) * inverse)
 
     def divideAll(self, divisor):
         """
         Divides all counts by divisor
         """
-        divisor = float(divisor)
+        inverse = 1.0 / float(divisor)
         for key in self:
-            self[key] /= divisor
+            dict.__setitem__(self, key, dict.__getitem__(self, key) * inverse)
 
     def copy(self):
         """
@@ -179,18 +218,22 @@ class Counter(dict):
         >>> a['fourth'] = 2.5
         >>> a * b
         14
+
+        Keys held by only one counter do not contribute, even when their
+        value is not finite:
+
+        >>> a['fifth'] = float('-inf')
+        >>> b['sixth'] = float('nan')
+        >>> a * b
+        14
         """
-        sum = 0
         x = self
         if len(x) > len(y):
             x,y = y,x
-        for key in x:
-            if key not in y:
-                continue
-            sum += x[key] * y[key]
-        return sum
+        getItem = dict.__getitem__
+        return sum(getItem(x, key) * getItem(y, key) for key in x.viewkeys() & y.viewkeys())
 
-    def __radd__(self, y):
+    def __iadd__(self, y):
         """
         Adding another counter to a counter increments the current counter
         by the values stored in the second counter.
@@ -205,8 +248,10 @@ class Counter(dict):
         >>> a['first']
         1
         """
-        for key, value in y.items():
-            self[key] += value
+        get = self.get
+        for key, value in y.iteritems():
+            dict.__setitem__(self, key, get(key, 0) + value)
+        return self
 
     def __add__( self, y ):
         """
@@ -223,15 +268,14 @@ class Counter(dict):
         1
         """
         addend = Counter()
-        for key in self:
-            if key in y:
-                addend[key] = self[key] + y[key]
-            else:
-                addend[key] = self[key]
-        for key in y:
-            if key in self:
-                continue
-            addend[key] = y[key]
+        setItem, getItem = dict.__setitem__, dict.__getitem__
+        selfKeys, yKeys = self.viewkeys(), y.viewkeys()
+        for key in selfKeys & yKeys:
+            setItem(addend, key, getItem(self, key) + getItem(y, key))
+        for key in selfKeys - yKeys:
+            setItem(addend, key, getItem(self, key))
+        for key in yKeys - selfKeys:
+            setItem(addend, key, getItem(y, key))
         return addend
 
     def __sub__( self, y ):
@@ -249,26 +293,71 @@ class Counter(dict):
         -5
         """
         addend = Counter()
-        for key in self:
-            if key in y:
-                addend[key] = self[key] - y[key]
-            else:
-                addend[key] = self[key]
-        for key in y:
-            if key in self:
-                continue
-            addend[key] = -1 * y[key]
+        setItem, getItem = dict.__setitem__, dict.__getitem__
+        selfKeys, yKeys = self.viewkeys(), y.viewkeys()
+        for key in selfKeys & yKeys:
+            setItem(addend, key, getItem(self, key) - getItem(y, key))
+        for key in selfKeys - yKeys:
+            setItem(addend, key, getItem(self, key))
+        for key in yKeys - selfKeys:
+            setItem(addend, key, -1 * getItem(y, key))
         return addend
 
+class CounterFast(defaultdict, Counter):
+    """
+    A Counter backed by defaultdict(int), for hot paths that only count.
+
+    Missing keys are filled in by defaultdict's C-level __missing__ hook
+    rather than a Python-level __getitem__, so incrementing is cheaper.
+    Unlike Counter, reading a missing key inserts it with a count of 0.
+
+    >>> a = CounterFast()
+    >>> a.incrementAll(['one', 'two', 'one'], 1)
+    >>> a['one']
+    2
+    >>> a.argMax()
+    'one'
+
+    It copies and pickles as a CounterFast:
+
+    >>> import copy, pickle
+    >>> copy.deepcopy(CounterFast({'one': 2}))
+    CounterFast({'one': 2})
+    >>> b = pickle.loads(pickle.dumps(a, 2))
+    >>> type(b) is CounterFast and b == a
+    True
+    """
+    __slots__ = ()
+    __getitem__ = dict.__getitem__
+
+    def __init__(self, *args, **kwargs):
+        defaultdict.__init__(self, int, *args, **kwargs)
+
+    def copy(self):
+        """
+        Returns a copy of the counter
+        """
+        return CounterFast(self)
+
+    __copy__ = copy
+
+    def __reduce__(self):
+        # defaultdict.__reduce__ passes the default factory to the
+        # constructor, which CounterFast fixes to int
+        return (CounterFast, (), None, None, self.iteritems())
+
+    def __repr__(self):
+        return 'CounterFast(%s)' % dict.__repr__(self)
+
 def normalize(vectorOrCounter):
     """
     normalize a vector or counter by dividing each value by the sum of all values
     """
-    normalizedCounter = Counter()
-    if type(vectorOrCounter) == type(normalizedCounter):
+    if isinstance(vectorOrCounter, Counter):
         counter = vectorOrCounter
         total = float(counter.totalCount())
         if total == 0: return counter
+        normalizedCounter = Counter()
         for key in counter.keys():
             value = counter[key]
             normalizedCounter[key] = value / total
@@ -279,40 +368,87 @@ def normalize(vectorOrCounter):
         if s == 0: return vector
         return [el / s for el in vector]
 
+def cumulativeSum(vector):
+    """
+    Returns the running totals of a vector, e.g. the CDF of a distribution.
+
+    >>> cumulativeSum([1, 2, 3])
+    [1, 3, 6]
+    """
+    total = 0
+    cumulative = []
+    for el in vector:
+        total += el
+        cumulative.append(total)
+    return cumulative
+
+def lastPossibleIndex(distribution):
+    """
+    Returns the index of the last entry with positive probability.
+
+    >>> lastPossibleIndex([0.5, 0.5, 0.0])
+    1
+    """
+    for i in xrange(len(distribution) - 1, -1, -1):
+        if distribution[i] > 0:
+            return i
+    raise ValueError("Distribution has no values with positive probability")
+
 def nSample(distribution, values, n):
-    if sum(distribution) != 1:
-        distribution = normalize(distribution)
-    rand = [random.random() for i in range(n)]
-    rand.sort()
-    samples = []
-    samplePos, distPos, cdf = 0,0, distribution[0]
-    while samplePos < n:
-        if rand[samplePos] < cdf:
-            samplePos += 1
-            samples.append(values[distPos])
-        else:
-            distPos += 1
-            cdf += distribution[distPos]
-    return samples
+    """
+    Draws n samples from the discrete distribution defined by
+    (distribution, values). Rounding can leave the last CDF entry just
+    under 1, so draws past it fall to the last value that is possible:
+
+    >>> realRandom = random.random
+    >>> random.random = lambda: 0.9999999999999999
+    >>> nSample([0.1] * 10 + [0.0], range(11), 2)
+    [9, 9]
+    >>> sample([0.1] * 10 + [0.0], range(11))
+    9
+    >>> random.random = realRandom
+    """
+    total = math.fsum(distribution)
+    if abs(total - 1.0) > 1e-12:
+        distribution = [d / total for d in distribution]
+    cdf = cumulativeSum(distribution)
+    # Rounding can leave the last CDF entry just under 1, so clamp the index
+    last = lastPossibleIndex(distribution)
+    bisectRight, rand = bisect.bisect_right, random.random
+    return [values[min(bisectRight(cdf, rand()), last)] for i in xrange(n)]
 
 def sample(distribution, values = None):
-    if type(distribution) == Counter:
+    if isinstance(distribution, dict):
         items = sorted(distribution.items())
         distribution = [i[1] for i in items]
         values = [i[0] for i in items]
-    if sum(distribution) != 1:
-        distribution = normalize(distribution)
-    choice = random.random()
-    i, total= 0, distribution[0]
-    while choice > total:
-        i += 1
-        total += distribution[i]
-    return values[i]
+    total = math.fsum(distribution)
+    if abs(total - 1.0) > 1e-12:
+        distribution = [d / total for d in distribution]
+    cdf = cumulativeSum(distribution)
+    last = lastPossibleIndex(distribution)
+    return values[min(bisect.bisect_left(cdf, random.random()), last)]
 
 def sampleFromCounter(ctr):
     items = sorted(ctr.items())
     return sample([v for k,v in items], [k for k,v in items])
 
+def indexDistribution(distribution, values):
+    """
+      Builds a value -> probability dict for a discrete distribution
+      defined by (distributions, values), summing repeated values. Index
+      once and look values up directly when querying the same
+      distribution many times.
+
+      >>> indexDistribution([0.25, 0.5, 0.25], ['a', 'b', 'a'])['a']
+      0.5
+    """
+    index = {}
+    get = index.get
+    for prob, val in zip(distribution, values):
+        index[val] = get(val, 0.0) + prob
+    return index
+
 def getProbability(value, distribution, values):
     """
       Gives the probability of a value under a discrete distribution
@@ -328,9 +464,14 @@ def flipCoin( p ):
     r = random.random()
     return r < p
 
+def flipCoins( p, n ):
+    "Flips n coins that each come up True with probability p"
+    rand = random.random
+    return [rand() < p for i in xrange(n)]
+
 def chooseFromDistribution( distribution ):
     "Takes either a counter or a list of (prob, key) pairs and samples"
-    if type(distribution) == dict or type(distribution) == Counter:
+    if isinstance(distribution, dict):
         return sample(distribution)
     r = random.random()
     base = 0.0